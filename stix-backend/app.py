@@ -1,17 +1,30 @@
 # app.py (FINAL: Corrected SyntaxError in HTTPError handling AND restored multi-value 'solution')
 
 import os
+import logging
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import math
+import hashlib
+import hmac
+import operator
+import itertools
 import traceback
-from flask import Flask, request, jsonify, send_from_directory
+import threading
+import tempfile
+from cachetools import LRUCache, TTLCache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, CancelledError, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider, DefaultJSONProvider
 from flask_cors import CORS
 from datetime import datetime, timezone
 
 # Import from stix_mapper and stix2
-from stix_mapper import map_flashpoint_vuln_to_stix, TLP_WHITE_DEFINITION
-from stix2 import Bundle
+from stix_mapper import map_flashpoint_vuln_to_stix, iter_bundle_json, unique_stix_objects, validate_stix_objects, FP_VULN_FIELDS
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -19,178 +32,555 @@ load_dotenv()
 FP_API_KEY = os.environ.get('FP_API_KEY')
 FP_VULN_API_URL = os.environ.get('FP_VULN_API_URL')
 FP_API_PAGE_SIZE = int(os.environ.get('FP_API_PAGE_SIZE', 500))
+FP_API_MAX_WORKERS = int(os.environ.get('FP_API_MAX_WORKERS', 8)) # Concurrent page requests after page 1
+FP_CACHE_TTL = int(os.environ.get('FP_CACHE_TTL', 300)) # Seconds a fetched vulnerability list is reused
+FP_BUNDLE_CACHE_TTL = int(os.environ.get('FP_BUNDLE_CACHE_TTL', 3600)) # Upper bound on reusing a generated bundle (also bucketed per UTC hour)
+FP_PAGE_CACHE_MAX = int(os.environ.get('FP_PAGE_CACHE_MAX', 128)) # Pages whose ETag + body are kept (memory and data/page_cache)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper() # INFO: a few lines per request; DEBUG adds per-page request/response details
+FP_API_CURSOR_PAGINATION = os.environ.get('FP_API_CURSOR_PAGINATION', '').lower() in ('1', 'true', 'yes') # search_after instead of from/size
+CRON_SECRET = os.environ.get('CRON_SECRET') # Bearer token the scheduler must send to /api/warm; unset disables the endpoint
+
+# One stderr handler for the backend's own loggers (app + stix_mapper), independent of how the host configures root logging
+_LOG_HANDLER = logging.StreamHandler()
+_LOG_HANDLER.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_LOG_LEVEL_NO = getattr(logging, LOG_LEVEL, None) # A mistyped LOG_LEVEL falls back to INFO instead of failing the import
+if not isinstance(_LOG_LEVEL_NO, int): _LOG_LEVEL_NO = None
+for _logger_name in (__name__, 'stix_mapper'):
+    _logger = logging.getLogger(_logger_name)
+    _logger.setLevel(logging.INFO if _LOG_LEVEL_NO is None else _LOG_LEVEL_NO); _logger.addHandler(_LOG_HANDLER); _logger.propagate = False
+log = logging.getLogger(__name__)
+if _LOG_LEVEL_NO is None: log.warning("Unknown LOG_LEVEL %r; using INFO.", LOG_LEVEL)
 
 # Configuration
 STIX_BUNDLE_DIR = "data"
 STIX_BUNDLE_FILENAME = "latest_stix_bundle.json"
 STIX_BUNDLE_PATH = os.path.join(STIX_BUNDLE_DIR, STIX_BUNDLE_FILENAME)
+FP_PAGE_CACHE_DIR = os.path.join(STIX_BUNDLE_DIR, "page_cache") # ETag + body of each page's last 200; survives restarts
+_API_URL = f"{(FP_VULN_API_URL or '').rstrip('/')}/vulnerabilities" # Built once; only used when FP_VULN_API_URL is set
+
+# --- Shared HTTP Session (keep-alive + connection pooling across pages and requests) ---
+# The pool is sized to the page fan-out so every concurrent page keeps its own kept-alive connection.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=max(16, FP_API_MAX_WORKERS), max_retries=Retry(
+    total=3, read=False, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"],
+    raise_on_status=False))) # Final 5xx is returned so raise_for_status still reports it as an HTTP error
+# read=False: a read timeout is raised at once as requests' Timeout instead of being retried (4 x 90 s) and wrapped
+_SESSION.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip, deflate, br"}) # br is decoded by urllib3 via the brotli package
+if FP_API_KEY: _SESSION.headers["Authorization"] = f"Bearer {FP_API_KEY}"
+
+# --- Response Caches ---
+# Per-process (each Flask worker / serverless instance has its own), keyed by the sorted query params.
+_CACHE_LOCK = threading.Lock()
+_FETCH_CACHE = TTLCache(maxsize=32, ttl=FP_CACHE_TTL) # params -> fetched vulnerability list
+_BUNDLE_CACHE = TTLCache(maxsize=32, ttl=FP_BUNDLE_CACHE_TTL) # (params, UTC hour) -> success message for the bundle currently on disk
+
+# (params, from, size) -> (ETag, page_vulnerabilities, data) of the last 200 for that page; lets an
+# unchanged page come back as a bodiless 304 that skips the download and the JSON decode.
+# Mirrored to FP_PAGE_CACHE_DIR so a restarted process can still send If-None-Match.
+class _PageETagCache(LRUCache):
+    """LRU of page entries; evicting a page also deletes its copy in FP_PAGE_CACHE_DIR, so both stay bounded."""
+    def popitem(self):
+        etag_key, value = super().popitem()
+        _remove_cached_page_file(etag_key)
+        return etag_key, value
+
+_PAGE_ETAGS = _PageETagCache(maxsize=FP_PAGE_CACHE_MAX)
+_PAGE_ETAGS_LOCK = threading.Lock() # Page threads share the LRU, and even a get() reorders it
+
+def _cache_key(params):
+    return tuple(sorted(params.items()))
+
+def _atomic_write(path, chunks):
+    """Writes chunks to a uniquely named temp file beside path and swaps it in, so concurrent writers never share a temp file."""
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", prefix=f"{os.path.basename(path)}.", suffix=".tmp", delete=False)
+    try:
+        with f: f.writelines(chunks)
+        os.replace(f.name, path)
+    except BaseException:
+        try: os.remove(f.name)
+        except OSError: pass
+        raise
+
+def _write_bundle(chunks):
+    """Writes bundle bytes chunks to a temp file and swaps it in atomically, so GETs never see a partial file."""
+    os.makedirs(STIX_BUNDLE_DIR, exist_ok=True)
+    _atomic_write(STIX_BUNDLE_PATH, chunks)
+
+def _bundle_cache_key(params):
+    # The relative published_after window moves continuously; the hour bucket caps how stale a reused bundle can be
+    return _cache_key(params), datetime.now(timezone.utc).strftime("%Y-%m-%dT%H")
+
+def _bust_caches(params):
+    """Drops the cached fetch result and bundle message for one query."""
+    with _CACHE_LOCK: _FETCH_CACHE.pop(_cache_key(params), None); _BUNDLE_CACHE.pop(_bundle_cache_key(params), None)
+
+# Fixed query for the test bundle (shared by the generate and warm endpoints)
+TEST_BUNDLE_PARAMS = {
+    "published_after": "-14d",
+    "exploit": "public",
+    "solution": "change_default,patch,upgrade,workaround", # Restored full list
+    "location": "remote",
+    "fields": ",".join(FP_VULN_FIELDS) # Only what the STIX mapper reads: smaller bodies, faster decode
+}
 
 # --- Flask App Setup ---
+class OrjsonProvider(JSONProvider):
+    """Routes jsonify / request.get_json through orjson; types orjson can't encode fall back to Flask's default handling."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, resources={r"/api/*": {"origins": ["http://localhost:3000", "https://your-nextjs-production-domain.com"]}}) # Adjust origins
 os.makedirs(STIX_BUNDLE_DIR, exist_ok=True)
 
 
-# --- API Helper Function with Pagination ---
-def get_all_flashpoint_vulnerabilities(params):
-    """Queries the Flashpoint API with pagination to get ALL matching vulnerabilities."""
-    if not FP_API_KEY: return {"error": "FP_API_KEY not configured in backend environment."}
-    if not FP_VULN_API_URL: return {"error": "FP_VULN_API_URL not configured in backend environment."}
+# --- API Helper Functions with Pagination ---
+class ResponseStructureError(Exception):
+    """Raised when a Flashpoint page does not contain a recognizable vulnerability list."""
 
-    headers = {"Authorization": f"Bearer {FP_API_KEY}", "Accept": "application/json"}
-    api_url = f"{FP_VULN_API_URL}/vulnerabilities"
-    all_vulnerabilities = []
-    current_page = 0
-    page_size = FP_API_PAGE_SIZE
-    total_hits = None
-    max_pages = 100
+def _extract_page_vulnerabilities(data):
+    """Returns the vulnerability list from one API page ('results', 'data' or 'hits.hits')."""
+    page_vulnerabilities = data.get('results', None)
+    if page_vulnerabilities is None:
+         page_vulnerabilities = data.get('data', [])
+         if not isinstance(page_vulnerabilities, list):
+              hits_data = data.get('hits', {})
+              if isinstance(hits_data, dict): page_vulnerabilities = hits_data.get('hits', [])
+              if not isinstance(page_vulnerabilities, list):
+                   log.error("Could not find vulnerability list under 'results', 'data', or 'hits.hits'. Keys: %s", list(data.keys()))
+                   raise ResponseStructureError("Unexpected API response structure: results list key not found.")
+    elif not isinstance(page_vulnerabilities, list):
+         log.error("Expected a list for 'results' key, got %s. Keys: %s", type(page_vulnerabilities), list(data.keys()))
+         raise ResponseStructureError("Unexpected API response structure: 'results' key did not contain a list.")
+    return page_vulnerabilities
+
+def _page_extractor(data):
+    """
+    Picks the list accessor for this API's response shape from one sample body, so later pages skip the
+    'results' / 'data' / 'hits.hits' fallback ladder. Returns _extract_page_vulnerabilities when no shape matches.
+    """
+    if isinstance(data.get('results'), list): return operator.itemgetter('results')
+    if isinstance(data.get('data'), list): return operator.itemgetter('data')
+    hits_data = data.get('hits')
+    if isinstance(hits_data, dict) and isinstance(hits_data.get('hits'), list): return lambda d: d['hits']['hits']
+    return _extract_page_vulnerabilities
 
-    print(f"Starting vulnerability fetch. Base URL: {api_url}, Initial Params: {params}")
+def _extract_total_hits(data):
+    """Robust total_hits extraction; returns an int or None when the API does not report it."""
+    raw_total = data.get('total_hits', data.get('total', None)); total_hits_val = None
+    if isinstance(raw_total, dict): total_hits_val = raw_total.get('value')
+    elif isinstance(raw_total, (int, str)): total_hits_val = raw_total
+    if total_hits_val is None: log.warning("Total hits not found."); return None
+    try: total_hits = int(total_hits_val); log.info("Total potential hits: %d", total_hits); return total_hits
+    except (ValueError, TypeError): log.warning("Bad total hits %r", total_hits_val); return None
 
-    while True:
-        page_params = params.copy()
-        page_params['from'] = current_page * page_size
-        page_params['size'] = page_size
-        print(f"Querying page {current_page + 1}... (from={page_params['from']}, size={page_params['size']})")
+def _fetch_page(api_url, params, page_index, page_size, page_params=None, extract=_extract_page_vulnerabilities, query_key=None):
+    """
+    GETs and parses one page. Returns (page_index, page_vulnerabilities, data); raises on any failure.
+    page_params is either a dict a sequential caller reuses for every page (only its 'from' slot is overwritten) or,
+    for concurrent callers, the query's (key, value) pairs frozen once; from/size are appended as a fresh list per page.
+    extract is the list accessor chosen by _page_extractor, used as long as pages keep that shape.
+    query_key is _cache_key(params), computed once by the caller instead of re-sorting params for every page.
+    """
+    offset = page_index * page_size
+    if isinstance(page_params, dict): page_params['from'] = offset; request_params = page_params
+    else: request_params = [*(page_params or params.items()), ('from', offset), ('size', page_size)] # No dict copy/rehash per page
+    log.debug("Querying page %d... (from=%d, size=%d)", page_index + 1, offset, page_size)
+    etag_key = (query_key or _cache_key(params), offset, page_size)
+    with _PAGE_ETAGS_LOCK: cached = _PAGE_ETAGS.get(etag_key)
+    cached = cached or _load_cached_page(etag_key, extract)
+    headers = {"If-None-Match": cached[0]} if cached else None
+    response = _SESSION.get(api_url, params=request_params, headers=headers, timeout=90)
+    if log.isEnabledFor(logging.DEBUG): log.debug("-> Request URL: %s", response.url) # response.url is rebuilt on every access
+    response.raise_for_status()
+    if response.status_code == 304 and cached:
+        log.debug("-> Page %d not modified; reusing %d cached results.", page_index + 1, len(cached[1]))
+        return page_index, cached[1], cached[2]
+    data = orjson.loads(response.content) # Parses the (decompressed) bytes directly, no intermediate str
+    # log.debug("-> Raw API Response (Page %d): %s", page_index + 1, json.dumps(data, indent=2)) # Keep commented unless needed
+    try: page_vulnerabilities = extract(data)
+    except (KeyError, TypeError): page_vulnerabilities = _extract_page_vulnerabilities(data) # Shape changed; full ladder
+    log.debug("-> Got %d results on page %d.", len(page_vulnerabilities), page_index + 1)
+    etag = response.headers.get('ETag')
+    if etag:
+        _save_cached_page(etag_key, etag, response.content)
+        with _PAGE_ETAGS_LOCK: _PAGE_ETAGS[etag_key] = (etag, page_vulnerabilities, data)
+    elif cached: _drop_cached_page(etag_key)
+    return page_index, page_vulnerabilities, data
 
+def _page_cache_path(etag_key):
+    return os.path.join(FP_PAGE_CACHE_DIR, hashlib.sha1(orjson.dumps(etag_key)).hexdigest() + ".json")
+
+def _load_cached_page(etag_key, extract):
+    """Reads a page's ETag and body saved by _save_cached_page; returns the _PAGE_ETAGS entry or None."""
+    try:
+        with open(_page_cache_path(etag_key), "rb") as f: etag, _, content = f.read().partition(b"\n")
+        data = orjson.loads(content)
+        try: page_vulnerabilities = extract(data)
+        except (KeyError, TypeError): page_vulnerabilities = _extract_page_vulnerabilities(data)
+    except FileNotFoundError: return None
+    except Exception as e: log.warning("Ignoring unreadable page cache entry: %s", e); return None
+    cached = (etag.decode('latin-1'), page_vulnerabilities, data)
+    with _PAGE_ETAGS_LOCK: _PAGE_ETAGS[etag_key] = cached
+    return cached
+
+def _save_cached_page(etag_key, etag, content):
+    """Stores the raw (decompressed) page body behind its ETag line; written atomically, failures only logged."""
+    path = _page_cache_path(etag_key)
+    try:
+        os.makedirs(FP_PAGE_CACHE_DIR, exist_ok=True)
+        _atomic_write(path, (etag.encode('latin-1') + b"\n", content))
+    except OSError as e: log.warning("Could not persist page cache entry: %s", e)
+
+def _remove_cached_page_file(etag_key):
+    try: os.remove(_page_cache_path(etag_key))
+    except OSError: pass
+
+def _drop_cached_page(etag_key):
+    with _PAGE_ETAGS_LOCK: _PAGE_ETAGS.pop(etag_key, None)
+    _remove_cached_page_file(etag_key)
+
+def _drop_pages_beyond(query_key, page_size, num_pages):
+    """Forgets this query's cached pages at or past num_pages once the probe has sized the result (the window shrank)."""
+    with _PAGE_ETAGS_LOCK:
+        stale = [k for k in _PAGE_ETAGS if k[0] == query_key and k[2] == page_size and k[1] >= num_pages * page_size]
+    for etag_key in stale: _drop_cached_page(etag_key)
+
+def _prune_page_cache_dir():
+    """Startup bound for FP_PAGE_CACHE_DIR: keeps the FP_PAGE_CACHE_MAX most recently written pages (earlier processes' leftovers)."""
+    try: paths = [os.path.join(FP_PAGE_CACHE_DIR, name) for name in os.listdir(FP_PAGE_CACHE_DIR) if name.endswith(".json")]
+    except OSError: return
+    if len(paths) <= FP_PAGE_CACHE_MAX: return
+    def mtime(path):
+        try: return os.stat(path).st_mtime_ns
+        except OSError: return 0
+    paths.sort(key=mtime, reverse=True)
+    for path in paths[FP_PAGE_CACHE_MAX:]:
+        try: os.remove(path)
+        except OSError: pass
+
+_prune_page_cache_dir()
+
+def _page_error(e, page_index):
+    """Turns an exception raised by _fetch_page into the {"error": ...} result returned to callers."""
+    page_number = page_index + 1
+    if isinstance(e, requests.exceptions.Timeout):
+        error_msg = f"API Timeout page {page_number}."; log.error(error_msg); return {"error": error_msg}
+    if isinstance(e, requests.exceptions.HTTPError):
+        error_detail = f"{e.response.status_code}: " # Get status code first
         try:
-            response = requests.get(api_url, headers=headers, params=page_params, timeout=90)
-            print(f"-> Request URL: {response.url}")
+            error_detail += e.response.content[:500].decode('utf-8', 'replace') # Slice the bytes first; .text would decode the whole body
+        except Exception:
+            error_detail += "(Could not read response body)"
+        log.error("HTTP Error on page %d: %s", page_number, error_detail)
+        return {"error": f"API HTTP Error on page {page_number}: {error_detail}"}
+    if isinstance(e, requests.exceptions.RequestException):
+        log.error("Network/Request Error on page %d: %s", page_number, e); return {"error": f"API Request Failed on page {page_number}: {e}"}
+    if isinstance(e, json.JSONDecodeError):
+        log.error("Failed to decode JSON on page %d: %s", page_number, e); return {"error": f"API JSON Decode Error on page {page_number}."}
+    if isinstance(e, ResponseStructureError): return {"error": str(e)}
+    log.error("Unexpected error during pagination: %s", ''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+    return {"error": f"Unexpected error during pagination: {e}"}
+
+def _fetch_pages_by_offset(api_url, params, page_size, max_pages, on_page=None):
+    """
+    from/size pagination. A count-only (size=0) request learns total_hits first; every page is then fetched concurrently.
+    Without a usable total_hits, pages are walked sequentially until a short page.
+    on_page(page_index, page_vulnerabilities) is called as each page arrives (completion order when concurrent).
+    """
+    # Phase 1: count-only probe, so a window with no matches costs no page transfer
+    try:
+        response = _SESSION.get(api_url, params=dict(params, size=0), timeout=90)
+        response.raise_for_status()
+        probe_data = orjson.loads(response.content)
+    except Exception as e: return _page_error(e, 0)
+    total_hits = _extract_total_hits(probe_data)
+    extract = _page_extractor(probe_data) # Response shape resolved once for every page below
+    query_key = _cache_key(params)
+    if total_hits is not None: _drop_pages_beyond(query_key, page_size, math.ceil(total_hits / page_size))
+    if total_hits == 0: log.info("No matching vulnerabilities; skipping page requests."); return {"vulnerabilities": []}
+
+    if total_hits is not None:
+        # Phase 2: all pages concurrently, reassembled in page order
+        num_pages = math.ceil(total_hits / page_size) # Exact; max_pages only bounds the walks that don't know the total
+        pages = [None] * num_pages
+        static_params = tuple(params.items()) # Shared read-only by every page request
+        with ThreadPoolExecutor(max_workers=min(FP_API_MAX_WORKERS, num_pages)) as executor: # Bounded like a semaphore; no idle threads for short results
+            futures = {executor.submit(_fetch_page, api_url, params, i, page_size, static_params, extract, query_key): i for i in range(num_pages)}
+            for future in as_completed(futures):
+                try: page_index, page_vulnerabilities, _ = future.result()
+                except Exception as e:
+                    for f in futures: f.cancel()
+                    return _page_error(e, futures[future])
+                pages[page_index] = page_vulnerabilities
+                if on_page: on_page(page_index, page_vulnerabilities)
+        return {"vulnerabilities": list(itertools.chain.from_iterable(pages))}
+
+    # Sequential fallback: no total to size the fan-out, so stop on a short page or when the API says there is no next page
+    page_params = dict(params, size=page_size) # Reused for every page; requests encodes it per call
+    all_vulnerabilities = []
+    for current_page in range(max_pages):
+        try: _, page_vulnerabilities, data = _fetch_page(api_url, params, current_page, page_size, page_params, extract, query_key)
+        except Exception as e: return _page_error(e, current_page)
+        all_vulnerabilities.extend(page_vulnerabilities)
+        if on_page: on_page(current_page, page_vulnerabilities)
+        num_returned = len(page_vulnerabilities)
+        if data.get("next") is None and num_returned > 0: break
+        if num_returned < page_size: break
+    else: log.warning("Max pages reached.")
+    return {"vulnerabilities": all_vulnerabilities}
+
+def _fetch_pages_by_cursor(api_url, params, page_size, max_pages, on_page=None):
+    """
+    Keyset pagination: each request passes the previous page's last (published_at, id) as search_after,
+    so the upstream never skips 'from' rows and inserts between pages can't shift items across page boundaries.
+    Strictly sequential (each page needs the previous cursor); stops on a short page.
+    """
+    page_params = dict(params, size=page_size, sort=["published_at:desc", "id:desc"])
+    all_vulnerabilities = []
+    extract = None
+    for current_page in range(max_pages):
+        log.debug("Querying page %d... (search_after=%s, size=%d)", current_page + 1, page_params.get('search_after'), page_size)
+        try:
+            response = _SESSION.get(api_url, params=page_params, timeout=90)
+            if log.isEnabledFor(logging.DEBUG): log.debug("-> Request URL: %s", response.url)
             response.raise_for_status()
-            data = response.json()
-            # print(f"-> Raw API Response (Page {current_page + 1}): {json.dumps(data, indent=2)}") # Keep commented unless needed
-
-            # Use 'results' key logic
-            page_vulnerabilities = data.get('results', None)
-            if page_vulnerabilities is None:
-                 page_vulnerabilities = data.get('data', [])
-                 if not isinstance(page_vulnerabilities, list):
-                      hits_data = data.get('hits', {})
-                      if isinstance(hits_data, dict): page_vulnerabilities = hits_data.get('hits', [])
-                      if not isinstance(page_vulnerabilities, list):
-                           print(f"Error: Could not find vulnerability list under 'results', 'data', or 'hits.hits'. Keys: {list(data.keys())}")
-                           return {"error": "Unexpected API response structure: results list key not found."}
-            elif not isinstance(page_vulnerabilities, list):
-                 print(f"Error: Expected a list for 'results' key, got {type(page_vulnerabilities)}. Keys: {list(data.keys())}")
-                 return {"error": "Unexpected API response structure: 'results' key did not contain a list."}
-
-            all_vulnerabilities.extend(page_vulnerabilities)
-
-            # Robust total_hits extraction
-            if total_hits is None:
-                raw_total = data.get('total_hits', data.get('total', None)); total_hits_val = None
-                if isinstance(raw_total, dict): total_hits_val = raw_total.get('value')
-                elif isinstance(raw_total, (int, str)): total_hits_val = raw_total
-                if total_hits_val is not None:
-                    try: total_hits = int(total_hits_val); print(f"Total potential hits: {total_hits}")
-                    except (ValueError, TypeError): total_hits = None; print(f"Warn: Bad total hits '{total_hits_val}'")
-                else: total_hits = None; print("Warn: Total hits not found.")
-
-            num_returned = len(page_vulnerabilities)
-            print(f"-> Got {num_returned} results on this page.")
-
-            # Stop conditions
-            if total_hits == 0: break
-            if total_hits is not None and len(all_vulnerabilities) >= total_hits: break
-            if data.get("next") is None and num_returned > 0: break
-            if num_returned < page_size: break
-            if current_page >= max_pages -1 : print(f"Warn: Max pages reached."); break
-            current_page += 1
-
-        except requests.exceptions.Timeout:
-             error_msg = f"API Timeout page {current_page + 1}."; print(f"Error: {error_msg}"); return {"error": error_msg}
-        # --- *** SYNTAX CORRECTED HTTPError Handling *** ---
-        except requests.exceptions.HTTPError as e:
-             error_detail = f"{e.response.status_code}: " # Get status code first
-             try:
-                  # Try appending response text on separate lines inside try block
-                  error_detail += e.response.text[:500] # Limit error text length
-             except Exception:
-                  error_detail += "(Could not read response body)"
-             # Ensure print and return are outside the inner try/except, but inside the outer except
-             print(f"Error: HTTP Error on page {current_page + 1}: {error_detail}")
-             return {"error": f"API HTTP Error on page {current_page + 1}: {error_detail}"}
-        # --- *** End Correction *** ---
-        except requests.exceptions.RequestException as e: print(f"Error: Network/Request Error on page {current_page + 1}: {e}"); return {"error": f"API Request Failed on page {current_page + 1}: {e}"}
-        except json.JSONDecodeError as e: print(f"Error: Failed to decode JSON on page {current_page + 1}: {e}"); return {"error": f"API JSON Decode Error on page {current_page + 1}."}
-        except Exception as e: print(f"Error: Unexpected error during pagination: {traceback.format_exc()}"); return {"error": f"Unexpected error during pagination: {e}"}
-
-    print(f"Total vulnerabilities fetched: {len(all_vulnerabilities)}")
+            data = orjson.loads(response.content)
+            if extract is None: extract = _page_extractor(data) # Response shape resolved on the first page
+            try: page_vulnerabilities = extract(data)
+            except (KeyError, TypeError): page_vulnerabilities = _extract_page_vulnerabilities(data)
+            search_after = None
+            if len(page_vulnerabilities) >= page_size: # A full page: the next request needs this page's last sort key
+                last = page_vulnerabilities[-1]
+                try: search_after = [last['timelines']['published_at'], last['id']]
+                except (KeyError, TypeError): pass # Not a dict, or a sort key is missing
+                if search_after is None or None in search_after: # requests would silently drop a None and send a malformed cursor
+                    raise ResponseStructureError(f"Unexpected API response structure: last item on page {current_page + 1} has no published_at/id for search_after.")
+        except Exception as e: return _page_error(e, current_page)
+        log.debug("-> Got %d results on page %d.", len(page_vulnerabilities), current_page + 1)
+        all_vulnerabilities.extend(page_vulnerabilities)
+        if on_page: on_page(current_page, page_vulnerabilities)
+        if search_after is None: break # Short page
+        page_params['search_after'] = search_after
+    else: log.warning("Max pages reached.")
     return {"vulnerabilities": all_vulnerabilities}
 
+def get_all_flashpoint_vulnerabilities(params, on_page=None):
+    """
+    Queries the Flashpoint API with pagination to get ALL matching vulnerabilities.
+    Uses from/size offsets (concurrent when total_hits is known), or search_after cursors when FP_API_CURSOR_PAGINATION is set.
+    on_page(page_index, page_vulnerabilities) lets a caller start processing pages while later ones are still in flight.
+    """
+    if not FP_API_KEY: return {"error": "FP_API_KEY not configured in backend environment."}
+    if not FP_VULN_API_URL: return {"error": "FP_VULN_API_URL not configured in backend environment."}
 
-# --- API Endpoints ---
+    api_url = _API_URL
+    page_size = FP_API_PAGE_SIZE
+    max_pages = 100 # Safety bound for the sequential and cursor walks; a known total_hits sizes the fan-out exactly
 
-@app.route('/api/generate_test_bundle', methods=['POST'])
-def generate_test_bundle_api():
-    """API endpoint to trigger bundle generation using fixed criteria."""
-    print(f"[{datetime.now()}] Received API request to generate test bundle...")
+    cache_key = _cache_key(params)
+    with _CACHE_LOCK: cached_vulnerabilities = _FETCH_CACHE.get(cache_key)
+    if cached_vulnerabilities is not None:
+        log.info("Using cached fetch result (%d vulnerabilities) for params: %s", len(cached_vulnerabilities), params)
+        if on_page:
+            for start in range(0, len(cached_vulnerabilities), page_size): on_page(start // page_size, cached_vulnerabilities[start:start + page_size])
+        return {"vulnerabilities": cached_vulnerabilities}
 
-    # --- Parameters with multi-value solution restored ---
-    params = {
-        "published_after": "-14d",
-        "exploit": "public",
-        "solution": "change_default,patch,upgrade,workaround", # Restored full list
-        "location": "remote"
-    }
-    # --- End Parameters ---
+    log.info("Starting vulnerability fetch. Base URL: %s, Initial Params: %s", api_url, params)
+    fetch_pages = _fetch_pages_by_cursor if FP_API_CURSOR_PAGINATION else _fetch_pages_by_offset
+    result = fetch_pages(api_url, params, page_size, max_pages, on_page)
+    if "error" in result: return result
 
-    print(f"Using filter parameters: {params}") # Log the exact params being used
+    all_vulnerabilities = result["vulnerabilities"]
+    log.info("Total vulnerabilities fetched: %d", len(all_vulnerabilities))
+    with _CACHE_LOCK: _FETCH_CACHE[cache_key] = all_vulnerabilities
+    return result
 
-    result = get_all_flashpoint_vulnerabilities(params)
+
+# Mapping workers, started on first use and reused across requests (a fresh pool per request re-pays process start-up)
+_MAP_WORKERS = os.cpu_count() or 1
+_MAX_LOGGED_MAP_ERRORS = 10 # Per bundle; beyond this mapping failures are only counted, so a bad mapper can't flood the logs
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def _get_pool():
+    """Returns the shared mapping ProcessPoolExecutor, creating it lazily so importing the app never forks."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None: _POOL = ProcessPoolExecutor(max_workers=_MAP_WORKERS)
+        return _POOL
+
+def _reset_pool(expected):
+    """Drops the shared pool only if it is still the one that failed; another request may already have replaced it."""
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not expected: return
+        _POOL.shutdown(wait=False) # No cancel_futures: queued chunks belong to every request sharing the pool
+        _POOL = None
+
+def _map_vuln_safely(vuln_data, with_traceback=True):
+    """Maps one vulnerability inside a worker process; returns (True, stix_objects) or (False, error_text) so one bad record doesn't abort the batch."""
+    try: return True, map_flashpoint_vuln_to_stix(vuln_data)
+    except Exception as map_err:
+        vuln_id_err = vuln_data.get('id', 'UNKNOWN') if isinstance(vuln_data, dict) else 'UNKNOWN'
+        error_text = f"Error mapping ID {vuln_id_err}: {map_err}"
+        return False, f"{error_text}\n{traceback.format_exc()}" if with_traceback else error_text
+
+def _map_chunk_safely(vulns):
+    """
+    One pool task: a slice of a page, so a single IPC round trip covers many vulnerabilities.
+    Only the chunk's first failure carries a formatted traceback; a broken mapper fails every record the same way.
+    """
+    results, traceback_pending = [], True
+    for vuln_data in vulns:
+        ok, mapped = _map_vuln_safely(vuln_data, with_traceback=traceback_pending)
+        if not ok: traceback_pending = False
+        results.append((ok, mapped))
+    return results
+
+
+def _build_bundle(params, validate=False):
+    """Fetch + map + save pipeline shared by the generate and warm endpoints. Returns (response_body, status_code)."""
+    # Each page is mapped on the process pool as soon as it arrives, overlapping STIX conversion with the remaining fetches
+    pool = _get_pool()
+    map_futures = [] # (page_index, chunk_start, future); sorted afterwards so object order follows page order
+    pool_errors = [] # First submit() failure; later pages are still fetched but no longer mapped
+    def on_page(page_index, page_vulnerabilities):
+        if pool_errors: return
+        chunk = max(1, math.ceil(len(page_vulnerabilities) / _MAP_WORKERS)) # Spread a page across every worker
+        for start in range(0, len(page_vulnerabilities), chunk):
+            try: map_futures.append((page_index, start, pool.submit(_map_chunk_safely, page_vulnerabilities[start:start + chunk])))
+            except (BrokenProcessPool, RuntimeError) as e: # A worker died, or another request already reset this pool
+                pool_errors.append(e); _reset_pool(pool); return
+    result = get_all_flashpoint_vulnerabilities(params, on_page=on_page)
+    if pool_errors:
+        for _, _, future in map_futures: future.cancel()
+        log.error("STIX mapping pool failed: %s", pool_errors[0]); return {"status": "error", "message": f"STIX mapping failed: {pool_errors[0]}"}, 500
     if "error" in result:
-        print(f"Error during fetch: {result['error']}")
-        return jsonify({"status": "error", "message": result["error"]}), 500
+        for _, _, future in map_futures: future.cancel()
+        log.error("Error during fetch: %s", result['error'])
+        _bust_caches(params) # Never keep serving a previous result for a query that is currently failing upstream
+        return {"status": "error", "message": result["error"]}, 500
 
     vulnerabilities = result.get("vulnerabilities", [])
     if not vulnerabilities:
-        print("No vulnerabilities found matching criteria with current filters.")
-        return jsonify({"status": "warning", "message": "No vulnerabilities found matching the specified criteria."}), 200
+        log.info("No vulnerabilities found matching criteria with current filters.")
+        return {"status": "warning", "message": "No vulnerabilities found matching the specified criteria."}, 200
 
-    print(f"Found {len(vulnerabilities)} matching vulnerabilities. Converting to STIX...")
+    log.info("Found %d matching vulnerabilities. Converting to STIX...", len(vulnerabilities))
     # (Rest of STIX conversion, bundling, saving logic remains the same)
     all_stix_objects = []
     processed_count = 0; conversion_errors = 0
-    for vuln_data in vulnerabilities:
-        try:
-            stix_objs_for_vuln = map_flashpoint_vuln_to_stix(vuln_data)
-            all_stix_objects.extend(stix_objs_for_vuln)
-            processed_count += 1
-        except Exception as map_err: conversion_errors += 1; vuln_id_err = vuln_data.get('id', 'UNKNOWN'); print(f"Error mapping ID {vuln_id_err}: {map_err}\n{traceback.format_exc()}")
-    print(f"Processed {processed_count} vulnerabilities. Generated {len(all_stix_objects)} STIX objects. Encountered {conversion_errors} mapping errors.")
+    try:
+        map_futures.sort(key=lambda entry: entry[:2])
+        for _, _, future in map_futures:
+            for ok, mapped in future.result():
+                if ok: all_stix_objects.extend(mapped); processed_count += 1
+                else:
+                    conversion_errors += 1
+                    if conversion_errors <= _MAX_LOGGED_MAP_ERRORS: log.error(mapped)
+    except (BrokenProcessPool, CancelledError) as e:
+        _reset_pool(pool) # A worker died (e.g. OOM-killed); the next request starts a fresh pool
+        e_text = str(e) or type(e).__name__ # CancelledError carries no message
+        log.error("STIX mapping pool failed: %s", e_text); return {"status": "error", "message": f"STIX mapping failed: {e_text}"}, 500
+    if conversion_errors > _MAX_LOGGED_MAP_ERRORS: log.error("%d further mapping errors not logged individually.", conversion_errors - _MAX_LOGGED_MAP_ERRORS)
+    all_stix_objects = list(unique_stix_objects(all_stix_objects)) # Shared Software repeats across vulnerabilities; count what is written
+    log.info("Processed %d vulnerabilities. Generated %d STIX objects. Encountered %d mapping errors.", processed_count, len(all_stix_objects), conversion_errors)
     if not all_stix_objects:
         err_msg = "No STIX objects generated despite finding vulnerabilities.";
         if conversion_errors > 0: err_msg += f" Check logs for {conversion_errors} mapping errors."
         else: err_msg += " Check mapping logic or source data structure."
-        print(f"Warning: {err_msg}"); return jsonify({"status": "warning", "message": err_msg}), 200
+        log.warning(err_msg); return {"status": "warning", "message": err_msg}, 200
+    if validate: # Debug opt-in: parse every distinct object with stix2, which validates it
+        try: validated_count = validate_stix_objects(all_stix_objects)
+        except Exception as e: log.error("STIX validation failed: %s", traceback.format_exc()); return {"status": "error", "message": f"STIX validation failed: {e}"}, 500
+        log.info("STIX validation passed for %d objects.", validated_count)
     try:
-        bundle = Bundle(objects=all_stix_objects + [TLP_WHITE_DEFINITION], allow_custom=True)
-        bundle_json = bundle.serialize(indent=2)
-        os.makedirs(STIX_BUNDLE_DIR, exist_ok=True)
-        with open(STIX_BUNDLE_PATH, "w", encoding="utf-8") as f: f.write(bundle_json)
-        save_msg = f"Bundle generated: {len(all_stix_objects)} objects saved ({len(vulnerabilities)} source vulns)."
+        _write_bundle(iter_bundle_json(all_stix_objects, include_tlp_white=True)) # Streamed object by object; appends the TLP:WHITE definition
+        save_msg = f"Bundle generated: {len(all_stix_objects) + 1} objects saved ({len(vulnerabilities)} source vulns)." # +1: the appended TLP:WHITE definition
         if conversion_errors > 0: save_msg += f" ({conversion_errors} mapping errors occurred - see logs)"
-        print(f"[{datetime.now()}] Successfully saved STIX bundle to {STIX_BUNDLE_PATH}")
-        return jsonify({"status": "success", "message": save_msg}), 200
-    except Exception as e: print(f"Error creating/saving STIX bundle: {traceback.format_exc()}"); return jsonify({"status": "error", "message": f"Failed to create/save bundle: {e}"}), 500
+        log.info("Successfully saved STIX bundle to %s", STIX_BUNDLE_PATH)
+        with _CACHE_LOCK: _BUNDLE_CACHE.clear(); _BUNDLE_CACHE[_bundle_cache_key(params)] = save_msg # Only the bundle on disk is reusable
+        return {"status": "success", "message": save_msg}, 200
+    except Exception as e: log.error("Error creating/saving STIX bundle: %s", traceback.format_exc()); return {"status": "error", "message": f"Failed to create/save bundle: {e}"}, 500
+
+
+# Bytes + ETag of the bundle file as last read, reloaded only when the file's mtime/size change
+_SERVED_BUNDLE = {"stat": None, "bytes": None, "etag": None}
+_SERVED_BUNDLE_LOCK = threading.Lock()
+
+def _load_served_bundle():
+    """Returns (bundle_bytes, etag) for the bundle on disk, reading the file only after it has been replaced."""
+    st = os.stat(STIX_BUNDLE_PATH)
+    stat_key = (st.st_mtime_ns, st.st_size)
+    with _SERVED_BUNDLE_LOCK:
+        if _SERVED_BUNDLE["stat"] != stat_key:
+            with open(STIX_BUNDLE_PATH, "rb") as f: body = f.read()
+            _SERVED_BUNDLE.update(stat=stat_key, bytes=body, etag=hashlib.md5(body, usedforsecurity=False).hexdigest())
+        return _SERVED_BUNDLE["bytes"], _SERVED_BUNDLE["etag"]
+
+
+# --- API Endpoints ---
+
+def _flag(name):
+    """Query-string boolean, parsed like the env flags: only 1/true/yes turn it on (so ?validate=0 stays off)."""
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+@app.route('/api/generate_test_bundle', methods=['POST'])
+def generate_test_bundle_api():
+    """API endpoint to trigger bundle generation using fixed criteria."""
+    log.info("Received API request to generate test bundle...")
+    params = TEST_BUNDLE_PARAMS
+    log.info("Using filter parameters: %s", params) # Log the exact params being used
+
+    validate = _flag('validate')
+    with _CACHE_LOCK: cached_msg = _BUNDLE_CACHE.get(_bundle_cache_key(params))
+    if cached_msg and os.path.exists(STIX_BUNDLE_PATH) and not validate:
+        log.info("Bundle for these parameters was already generated this hour; reusing it.")
+        return jsonify({"status": "success", "message": cached_msg}), 200
+
+    body, status = _build_bundle(params, validate=validate)
+    return jsonify(body), status
+
+
+@app.route('/api/warm', methods=['GET', 'POST'])
+def warm_api():
+    """Scheduled (cron) prefetch: rebuilds the test bundle regardless of the caches so the next user request is served warm."""
+    if not CRON_SECRET: log.warning("Rejected /api/warm: CRON_SECRET is not configured."); return jsonify({"error": "Warm endpoint is disabled."}), 503
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {CRON_SECRET}".encode()): return jsonify({"error": "Unauthorized."}), 401
+    log.info("Warming test bundle cache...")
+    _bust_caches(TEST_BUNDLE_PARAMS) # Page ETags still make unchanged pages cheap to refetch
+    body, status = _build_bundle(TEST_BUNDLE_PARAMS)
+    return jsonify(body), status
 
 
 @app.route('/api/stix_bundle.json', methods=['GET'])
 def get_stix_bundle_api():
     # (Keep as before)
-    print(f"[{datetime.now()}] Request received for /api/stix_bundle.json")
-    if not os.path.exists(STIX_BUNDLE_PATH): print("Bundle file not found."); return jsonify({"error": "STIX bundle has not been generated yet."}), 404
-    try: print(f"Serving bundle file from {STIX_BUNDLE_PATH}"); return send_from_directory( STIX_BUNDLE_DIR, STIX_BUNDLE_FILENAME, mimetype='application/json', as_attachment=False )
-    except Exception as e: print(f"Error serving bundle file: {traceback.format_exc()}"); return jsonify({"error": f"Failed to serve bundle file: {e}"}), 500
+    log.info("Request received for /api/stix_bundle.json")
+    if not os.path.exists(STIX_BUNDLE_PATH): log.warning("Bundle file not found."); return jsonify({"error": "STIX bundle has not been generated yet."}), 404
+    try:
+        body, etag = _load_served_bundle()
+        if _flag('pretty'): # Opt-in: the stored bundle is compact, indent only for human debugging
+            log.info("Serving pretty-printed bundle from %s", STIX_BUNDLE_PATH)
+            return app.response_class(orjson.dumps(orjson.loads(body), option=orjson.OPT_INDENT_2), mimetype='application/json')
+        log.info("Serving bundle from memory (%s)", STIX_BUNDLE_PATH)
+        response = app.response_class(body, mimetype='application/json')
+        response.set_etag(etag); response.cache_control.max_age = 60
+        return response.make_conditional(request) # 304 with no body when If-None-Match matches
+    except Exception as e: log.error("Error serving bundle file: %s", traceback.format_exc()); return jsonify({"error": f"Failed to serve bundle file: {e}"}), 500
 
 # --- Run the App ---
 if __name__ == '__main__':
     # (Keep checks and run command as before)
-    if not FP_API_KEY: print("ERROR: FP_API_KEY must be set in .env file!")
-    if not FP_VULN_API_URL: print("ERROR: FP_VULN_API_URL must be set in .env file!")
+    if not FP_API_KEY: log.error("FP_API_KEY must be set in .env file!")
+    if not FP_VULN_API_URL: log.error("FP_VULN_API_URL must be set in .env file!")
     if FP_API_KEY and FP_VULN_API_URL:
-         print(f"Starting Flask API server for STIX generation...")
+         log.info("Starting Flask API server for STIX generation...")
          # ... (rest of startup messages) ...
          app.run(debug=True, port=5001, host='127.0.0.1')
     else:
-         print("Exiting due to missing environment variables.")
\ No newline at end of file
+         log.error("Exiting due to missing environment variables.")
\ No newline at end of file
@@ -1,10 +1,20 @@
 # stix_mapper.py (Corrected and Complete: Fixes syntax, imports, markings, adds simplified Software/Relationship)
 
+import os
 import json
+import logging
+import uuid
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import ciso8601
+import ijson
+import orjson
 from datetime import datetime, timezone
 from stix2 import (Vulnerability, Software, Relationship, ExternalReference, Note, Bundle,
-                   TLP_WHITE, StatementMarking, MarkingDefinition)
-from stix2.utils import format_datetime # Only format_datetime needed from utils
+                   TLP_WHITE, StatementMarking, MarkingDefinition, parse as stix2_parse)
+
+log = logging.getLogger(__name__)
 
 # --- Constants ---
 CVSSV3_EXTENSION_ID = "extension-definition--66e2492a-bbd3-4be6-88f5-cc91a017ac34"
@@ -14,13 +24,31 @@ TLP_WHITE_DEFINITION = MarkingDefinition(
      definition_type="statement",
      definition={"statement": "TLP:WHITE"}
 )
+_TLP_WHITE_REFS = (TLP_WHITE_DEFINITION.id,) # Resolved once; copied into object_marking_refs lists
+_TLP_WHITE_JSON = orjson.dumps(orjson.loads(TLP_WHITE_DEFINITION.serialize())) # Constant; encoded once and spliced into bundles
+_FP_SOURCE_NAME = "Flashpoint Vulnerability Intelligence"
+_FP_SOURCE_REF_TEMPLATE = "Flashpoint Vulnerability ID: {}"
+_EXT_REF_MAP = {'cve id': 'cve', 'cwe id': 'cwe'} # Lowercased Flashpoint ext reference type -> STIX source_name
+_FAST = True # Emit plain STIX 2.1 dicts (no stix2 validation); set False to build stix2 objects instead
+_STIX_SPEC_VERSION = "2.1"
+_FP_ID_NAMESPACE = uuid.UUID("e48325f5-ddc3-4e0b-b650-6824e0df30cf") # uuid5 namespace for Flashpoint-derived IDs
+_SCO_ID_NAMESPACE = uuid.UUID("00abedb4-aa42-466c-9c01-fed23315a9b7") # STIX 2.1 namespace for SCO deterministic IDs
+# Top-level Flashpoint vulnerability fields read by map_flashpoint_vuln_to_stix; request only these (fields= projection)
+FP_VULN_FIELDS = ('id', 'title', 'description', 'solution', 'creditees', 'timelines', 'cve_ids', 'cwes', 'ext_references',
+                  'tags', 'scores', 'vuln_status', 'classifications', 'cvss_v2s', 'cvss_v3s', 'cvss_v4s', 'products', 'vendors')
 
 # --- Helper Functions ---
 
 def parse_flashpoint_datetime(dt_string):
-    """Safely parses Flashpoint datetime strings into timezone-aware datetimes using built-in methods."""
+    """Safely parses Flashpoint datetime strings into timezone-aware datetimes (ciso8601, built-in fallback)."""
     if not dt_string:
         return None
+    try: # Fast path: C parser handles the ISO 8601 shapes Flashpoint emits
+        dt_obj = ciso8601.parse_datetime(dt_string)
+        if dt_obj.tzinfo is None: return dt_obj.replace(tzinfo=timezone.utc) # No offset given, Flashpoint times are UTC
+        return dt_obj
+    except (ValueError, TypeError): # Malformed or non-string values fall through to the fallback and its warning
+        pass
     try:
         needs_tz = 'Z' not in dt_string and '+' not in dt_string
         if needs_tz:
@@ -30,244 +58,388 @@ def parse_flashpoint_datetime(dt_string):
         if dt_string.endswith('Z'): dt_string = dt_string[:-1] + '+00:00'
         dt_obj = datetime.fromisoformat(dt_string)
         if dt_obj.tzinfo is None or dt_obj.tzinfo.utcoffset(dt_obj) is None:
-             print(f"Warning: Parsed datetime '{dt_string}' naive. Assuming UTC.")
+             log.warning("Parsed datetime %r naive. Assuming UTC.", dt_string)
              return dt_obj.replace(tzinfo=timezone.utc)
         return dt_obj
     except Exception as e:
-        print(f"Warning: Could not parse datetime '{dt_string}': {e}")
+        log.warning("Could not parse datetime %r: %s", dt_string, e)
+        return None
+
+def _fmt(dt):
+    """Formats an aware datetime as a STIX timestamp (UTC, millisecond precision) without stix2.utils."""
+    dt = dt.astimezone(timezone.utc)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.') + f"{dt.microsecond // 1000:03d}Z"
+
+def _safe_float(value, what, fp_id):
+    """float(value), or None when the value is missing or unparseable (the latter logged as a warning)."""
+    if value is None: return None
+    try: return float(value)
+    except (ValueError, TypeError):
+        log.warning("Could not parse %s %r for vuln %s", what, value, fp_id)
         return None
 
+def make_ext_ref(**props):
+    """Builds an external reference as a plain dict (fast path) or a validated stix2 ExternalReference."""
+    return props if _FAST else ExternalReference(**props)
+
+def software_id(product_name, vendor_name):
+    """Deterministic STIX 2.1 Software ID (same uuid5 derivation stix2 uses for name/vendor)."""
+    contributing = json.dumps({"name": product_name, "vendor": vendor_name}, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return f"software--{uuid.uuid5(_SCO_ID_NAMESPACE, contributing)}"
+
+@functools.lru_cache(maxsize=100_000)
+def _get_software(vendor_name, product_name):
+    """
+    Returns the shared Software object for a vendor/product, reused across every vulnerability in the process.
+    The ID is deterministic, so repeats across vulnerabilities collapse into one bundle object.
+    Call _get_software.cache_clear() after toggling _FAST.
+    """
+    if _FAST:
+        return { "type": "software", "spec_version": _STIX_SPEC_VERSION, "id": software_id(product_name, vendor_name),
+                 "name": product_name, "vendor": vendor_name, "object_marking_refs": list(_TLP_WHITE_REFS) }
+    return Software( id=software_id(product_name, vendor_name), name=product_name, vendor=vendor_name,
+                     object_marking_refs=list(_TLP_WHITE_REFS), allow_custom=True )
+
+def unique_stix_objects(stix_objects):
+    """Yields each STIX object once per ID (first one wins); shared Software objects repeat across vulnerabilities."""
+    seen_ids = set()
+    for o in stix_objects:
+        if o['id'] in seen_ids: continue
+        seen_ids.add(o['id'])
+        yield o
+
+def iter_bundle_json(stix_objects, bundle_id=None, include_tlp_white=False):
+    """
+    Yields a STIX 2.1 bundle as orjson-encoded bytes fragments, one object at a time, so the full document is never held in memory.
+    include_tlp_white appends the pre-encoded TLP:WHITE marking definition (unless already present) without re-serializing it.
+    """
+    yield b'{"type":"bundle","id":' + orjson.dumps(bundle_id or f"bundle--{uuid.uuid4()}") + b',"objects":['
+    separator, has_tlp_white = b'', False
+    for o in unique_stix_objects(stix_objects):
+        has_tlp_white = has_tlp_white or o['id'] == TLP_WHITE_DEFINITION.id
+        yield separator + (orjson.dumps(o) if isinstance(o, dict) else o.serialize().encode('utf-8'))
+        separator = b','
+    if include_tlp_white and not has_tlp_white: yield separator + _TLP_WHITE_JSON
+    yield b']}'
+
+def to_bundle_bytes(stix_objects, pretty=False):
+    """Serializes STIX objects as one STIX 2.1 bundle JSON document (bytes); pretty re-encodes it with 2-space indents."""
+    bundle_bytes = b''.join(iter_bundle_json(stix_objects))
+    return orjson.dumps(orjson.loads(bundle_bytes), option=orjson.OPT_INDENT_2) if pretty else bundle_bytes
+
+def build_vendor_map(vendors_list):
+    """Maps Flashpoint vendor IDs to names for one 'vendors' section; malformed entries are skipped."""
+    vendor_map = {}
+    try:
+        for v in vendors_list or ():
+            try: v_id, v_name = v.get('id'), v.get('name')
+            except AttributeError: continue # Not a dict
+            if v_id and v_name: vendor_map[v_id] = v_name
+    except TypeError: pass # Section not iterable
+    return vendor_map
+
+def build_global_vendor_map(fp_vulns):
+    """Walks a whole feed once and merges every vulnerability's vendors into one ID -> name map."""
+    global_vendor_map = {}
+    for fp_vuln_data in fp_vulns:
+        if isinstance(fp_vuln_data, dict): global_vendor_map.update(build_vendor_map(fp_vuln_data.get('vendors')))
+    return global_vendor_map
+
 def map_ext_ref_type(fp_ref_type):
-    """Maps Flashpoint reference type to STIX source_name or returns None."""
+    """Maps Flashpoint reference type to STIX source_name or returns None (URL and unknown types)."""
     if not fp_ref_type: return None
-    fp_ref_type = fp_ref_type.lower()
-    if fp_ref_type == 'cve id': return 'cve'
-    elif fp_ref_type == 'cwe id': return 'cwe'
-    elif 'url' in fp_ref_type: return None
-    return None
+    return _EXT_REF_MAP.get(fp_ref_type.lower())
 
 # --- Main Mapping Function ---
 
-def map_flashpoint_vuln_to_stix(fp_vuln_data):
+def map_flashpoint_vuln_to_stix(fp_vuln_data, global_vendor_map=None):
     """
     Maps a single Flashpoint Vulnerability JSON object to a list of STIX 2.1 objects.
     Includes base Software/Relationship mapping. Compatible with stix2==3.0.1.
+    Returns plain STIX 2.1 dicts when _FAST is set (the default; see validate_stix_objects), stix2 objects otherwise.
+    global_vendor_map (see build_global_vendor_map) is consulted before this vulnerability's own vendors list.
     """
     if not fp_vuln_data or not fp_vuln_data.get('id'):
-         print("Warning: Insufficient data provided to map vulnerability (missing ID). Skipping.")
+         log.warning("Insufficient data provided to map vulnerability (missing ID). Skipping.")
          return []
 
     stix_objects = []
-    software_cache = {} # Cache based on Vendor::Product name
-    fp_id = fp_vuln_data.get('id')
-    fp_title = fp_vuln_data.get('title')
-    fp_description = fp_vuln_data.get('description', '')
-    fp_solution = fp_vuln_data.get('solution')
-    fp_creditees = fp_vuln_data.get('creditees')
+    marking_refs = list(_TLP_WHITE_REFS) # One list per vulnerability, shared by its SDO and every Relationship
+    emitted_software_ids = set() # Software already appended for this vulnerability
+    vuln_get = fp_vuln_data.get # Bound once; every field below is read through this local
+    fp_id = vuln_get('id')
+    fp_title = vuln_get('title')
+    fp_description = vuln_get('description', '')
+    fp_solution = vuln_get('solution')
+    fp_creditees = vuln_get('creditees')
 
     # --- Timestamps ---
-    timelines = fp_vuln_data.get('timelines', {})
-    if not isinstance(timelines, dict): timelines = {}
-    created_at = parse_flashpoint_datetime(timelines.get('published_at'))
-    modified_at = parse_flashpoint_datetime(timelines.get('last_modified_at'))
-    disclosed_at = parse_flashpoint_datetime(timelines.get('disclosed_at'))
-    exploit_published_at = parse_flashpoint_datetime(timelines.get('exploit_published_at'))
+    # Sections are trusted to have the documented shape; malformed ones are skipped via the except branches (EAFP)
+    try: timeline_get = vuln_get('timelines', {}).get
+    except AttributeError: timeline_get = {}.get
+    created_at = parse_flashpoint_datetime(timeline_get('published_at'))
+    modified_at = parse_flashpoint_datetime(timeline_get('last_modified_at'))
+    disclosed_at = parse_flashpoint_datetime(timeline_get('disclosed_at'))
+    exploit_published_at = parse_flashpoint_datetime(timeline_get('exploit_published_at'))
 
     # --- External References ---
     external_references = []
-    cve_ids_list = fp_vuln_data.get('cve_ids', [])
+    seen_refs = set() # (source_name, external_id) pairs already in external_references
+    cve_ids_list = vuln_get('cve_ids', [])
     if isinstance(cve_ids_list, list):
         for cve_id in cve_ids_list:
-             if cve_id and isinstance(cve_id, str): external_references.append(ExternalReference(source_name="cve", external_id=cve_id))
-    cwes_list = fp_vuln_data.get('cwes', [])
-    if isinstance(cwes_list, list):
-        for cwe_info in cwes_list:
-             if isinstance(cwe_info, dict):
-                 cwe_id_val = cwe_info.get('cwe_id')
-                 if cwe_id_val:
-                      try: external_references.append(ExternalReference(source_name="cwe", external_id=f"CWE-{int(cwe_id_val)}"))
-                      except (ValueError, TypeError): print(f"Warning: Invalid CWE ID format '{cwe_id_val}' for vuln {fp_id}")
-    ext_refs_list = fp_vuln_data.get('ext_references', [])
-    if isinstance(ext_refs_list, list):
-        for ref in ext_refs_list:
-             if not isinstance(ref, dict): continue
-             ref_type = ref.get('type'); ref_value = ref.get('value')
+             if cve_id and isinstance(cve_id, str):
+                 external_references.append(make_ext_ref(source_name="cve", external_id=cve_id)); seen_refs.add(("cve", cve_id))
+    try:
+        for cwe_info in vuln_get('cwes') or ():
+             try: cwe_id_val = cwe_info.get('cwe_id')
+             except AttributeError: continue # Not a dict
+             if cwe_id_val:
+                  try:
+                      cwe_ext_id = f"CWE-{int(cwe_id_val)}"
+                      external_references.append(make_ext_ref(source_name="cwe", external_id=cwe_ext_id)); seen_refs.add(("cwe", cwe_ext_id))
+                  except (ValueError, TypeError): log.warning("Invalid CWE ID format %r for vuln %s", cwe_id_val, fp_id)
+    except TypeError: pass # Section not iterable
+    try:
+        for ref in vuln_get('ext_references') or ():
+             try: ref_type = ref.get('type'); ref_value = ref.get('value')
+             except AttributeError: continue # Not a dict
              if not (ref_type and ref_value and isinstance(ref_value, str)): continue
-             source_name = map_ext_ref_type(ref_type)
+             ref_type_lc = ref_type.lower()
+             source_name = _EXT_REF_MAP.get(ref_type_lc)
              if source_name:
                  id_val = f"CWE-{ref_value}" if source_name == 'cwe' else ref_value
-                 is_duplicate = any(er.source_name == source_name and er.external_id == id_val for er in external_references)
-                 if not is_duplicate: external_references.append(ExternalReference(source_name=source_name, external_id=ref_value))
-             elif 'url' in ref_type.lower(): external_references.append(ExternalReference(source_name=ref_type, url=ref_value))
-    external_references.append(ExternalReference(source_name="Flashpoint Vulnerability Intelligence", description=f"Flashpoint Vulnerability ID: {fp_id}"))
+                 if (source_name, id_val) not in seen_refs:
+                     external_references.append(make_ext_ref(source_name=source_name, external_id=ref_value)); seen_refs.add((source_name, ref_value))
+             elif 'url' in ref_type_lc: external_references.append(make_ext_ref(source_name=ref_type, url=ref_value))
+    except TypeError: pass # Section not iterable
+    external_references.append(make_ext_ref(source_name=_FP_SOURCE_NAME, description=_FP_SOURCE_REF_TEMPLATE.format(fp_id)))
 
     # --- Labels ---
-    labels = []
-    tags_list = fp_vuln_data.get('tags', [])
+    labels = set() # Deduplicated as built; sorted once when the SDO is created
+    tags_list = vuln_get('tags', [])
     if isinstance(tags_list, list):
         for tag in tags_list:
-             if tag and isinstance(tag, str): labels.append(f"fp-tag:{tag}")
-    scores_dict = fp_vuln_data.get('scores', {})
-    if not isinstance(scores_dict, dict): scores_dict = {}
-    severity = scores_dict.get('severity')
-    if severity and isinstance(severity, str): labels.append(f"fp-severity:{severity.lower()}")
-    status = fp_vuln_data.get('vuln_status')
-    if status and isinstance(status, str): labels.append(f"fp-status:{status.lower()}")
-    classifications_list = fp_vuln_data.get('classifications', [])
-    if isinstance(classifications_list, list):
-        for classification in classifications_list:
-             if isinstance(classification, dict):
-                 class_name = classification.get('name')
-                 if class_name and isinstance(class_name, str): labels.append(f"fp-classification:{class_name}")
-    if exploit_published_at: labels.append("exploit-available")
+             if tag and isinstance(tag, str): labels.add(f"fp-tag:{tag}")
+    try: score_get = vuln_get('scores', {}).get
+    except AttributeError: score_get = {}.get
+    severity = score_get('severity')
+    if severity and isinstance(severity, str): labels.add(f"fp-severity:{severity.lower()}")
+    status = vuln_get('vuln_status')
+    if status and isinstance(status, str): labels.add(f"fp-status:{status.lower()}")
+    try:
+        for classification in vuln_get('classifications') or ():
+             try: class_name = classification.get('name')
+             except AttributeError: continue # Not a dict
+             if class_name and isinstance(class_name, str): labels.add(f"fp-classification:{class_name}")
+    except TypeError: pass # Section not iterable
+    if exploit_published_at: labels.add("exploit-available")
 
     # --- Description Enhancements ---
-    full_description = fp_description
-    if fp_solution: full_description += f"\n\nSolution: {fp_solution}"
+    description_parts = [fp_description] # Joined once below
+    if fp_solution: description_parts.append(f"\n\nSolution: {fp_solution}")
     if fp_creditees and isinstance(fp_creditees, list):
-        creds = ", ".join([c.get('name', 'Unknown') for c in fp_creditees if isinstance(c, dict) and c.get('name')])
-        if creds: full_description += f"\n\nCredits: {creds}"
-    if isinstance(disclosed_at, datetime): full_description += f"\n\nDisclosed On: {format_datetime(disclosed_at)}"
-    if isinstance(exploit_published_at, datetime): full_description += f"\n\nExploit Published On: {format_datetime(exploit_published_at)}"
+        creds = ", ".join(c.get('name', 'Unknown') for c in fp_creditees if isinstance(c, dict) and c.get('name'))
+        if creds: description_parts.append(f"\n\nCredits: {creds}")
+    if isinstance(disclosed_at, datetime): description_parts.append(f"\n\nDisclosed On: {_fmt(disclosed_at)}")
+    if isinstance(exploit_published_at, datetime): description_parts.append(f"\n\nExploit Published On: {_fmt(exploit_published_at)}")
+    full_description = "".join(description_parts)
 
     # --- CVSS Scores and Extensions (Dictionary Method) ---
     extensions = {}
-    cvss_v3_list = fp_vuln_data.get('cvss_v3s', [])
+    cvss_v3_list = vuln_get('cvss_v3s', [])
     if cvss_v3_list and isinstance(cvss_v3_list, list) and cvss_v3_list:
         cvss_v3_data = cvss_v3_list[0]
         if isinstance(cvss_v3_data, dict):
-            # --- CORRECTED Syntax for score parsing ---
-            base_score_v3, temporal_score_v3 = None, None
-            try: # Parse scores safely
-                if cvss_v3_data.get('score') is not None:
-                    base_score_v3 = float(cvss_v3_data['score'])
-                if cvss_v3_data.get('temporal_score') is not None:
-                    temporal_score_v3 = float(cvss_v3_data['temporal_score'])
-            except (ValueError, TypeError):
-                print(f"Warning: Could not parse CVSSv3 score for vuln {fp_id}")
-                base_score_v3, temporal_score_v3 = None, None
-            # --- End Correction ---
-            cvss_v3_dict = { "spec_version": "3.1", "version": str(cvss_v3_data.get('version', '3.1')), "vectorString": cvss_v3_data.get('vector_string'), "baseScore": base_score_v3, "attackVector": cvss_v3_data.get('attack_vector'), "attackComplexity": cvss_v3_data.get('attack_complexity'), "privilegesRequired": cvss_v3_data.get('privileges_required'), "userInteraction": cvss_v3_data.get('user_interaction'), "scope": cvss_v3_data.get('scope'), "confidentialityImpact": cvss_v3_data.get('confidentiality_impact'), "integrityImpact": cvss_v3_data.get('integrity_impact'), "availabilityImpact": cvss_v3_data.get('availability_impact'), "exploitCodeMaturity": cvss_v3_data.get('exploit_code_maturity'), "remediationLevel": cvss_v3_data.get('remediation_level'), "reportConfidence": cvss_v3_data.get('report_confidence'), "temporalScore": temporal_score_v3, "baseSeverity": severity if severity else None }
-            cvss_v3_dict_filtered = {k: v for k, v in cvss_v3_dict.items() if v is not None}
-            if cvss_v3_dict_filtered: extensions[CVSSV3_EXTENSION_ID] = cvss_v3_dict_filtered
-
-    cvss_v2_list = fp_vuln_data.get('cvss_v2s', [])
+            v3_get = cvss_v3_data.get
+            base_score_v3 = _safe_float(v3_get('score'), "CVSSv3 score", fp_id)
+            temporal_score_v3 = _safe_float(v3_get('temporal_score'), "CVSSv3 temporal score", fp_id)
+            # Single pass: only non-None values are ever inserted
+            cvss_v3_dict = {k: v for k, v in (
+                ("spec_version", "3.1"), ("version", str(v3_get('version', '3.1'))), ("vectorString", v3_get('vector_string')),
+                ("baseScore", base_score_v3), ("attackVector", v3_get('attack_vector')), ("attackComplexity", v3_get('attack_complexity')),
+                ("privilegesRequired", v3_get('privileges_required')), ("userInteraction", v3_get('user_interaction')), ("scope", v3_get('scope')),
+                ("confidentialityImpact", v3_get('confidentiality_impact')), ("integrityImpact", v3_get('integrity_impact')),
+                ("availabilityImpact", v3_get('availability_impact')), ("exploitCodeMaturity", v3_get('exploit_code_maturity')),
+                ("remediationLevel", v3_get('remediation_level')), ("reportConfidence", v3_get('report_confidence')),
+                ("temporalScore", temporal_score_v3), ("baseSeverity", severity if severity else None),
+            ) if v is not None}
+            extensions[CVSSV3_EXTENSION_ID] = cvss_v3_dict
+
+    cvss_v2_list = vuln_get('cvss_v2s', [])
     if cvss_v2_list and isinstance(cvss_v2_list, list) and cvss_v2_list:
         cvss_v2_data = cvss_v2_list[0]
         if isinstance(cvss_v2_data, dict):
-            # --- CORRECTED Syntax for score parsing ---
-            base_score_v2 = None
-            try:
-                if cvss_v2_data.get('score') is not None:
-                    base_score_v2 = float(cvss_v2_data['score'])
-            except (ValueError, TypeError):
-                print(f"Warning: Could not parse CVSSv2 score for vuln {fp_id}")
-                base_score_v2 = None
-            # --- End Correction ---
-            cvss_v2_dict = { "spec_version": "2.0", "version": "2.0", "baseScore": base_score_v2, "accessVector": cvss_v2_data.get('access_vector'), "accessComplexity": cvss_v2_data.get('access_complexity'), "authentication": cvss_v2_data.get('authentication'), "confidentialityImpact": cvss_v2_data.get('confidentiality_impact'), "integrityImpact": cvss_v2_data.get('integrity_impact'), "availabilityImpact": cvss_v2_data.get('availability_impact'), }
-            cvss_v2_dict_filtered = {k: v for k, v in cvss_v2_dict.items() if v is not None}
-            if cvss_v2_dict_filtered: extensions[CVSSV2_EXTENSION_ID] = cvss_v2_dict_filtered
+            v2_get = cvss_v2_data.get
+            base_score_v2 = _safe_float(v2_get('score'), "CVSSv2 score", fp_id)
+            cvss_v2_dict = {k: v for k, v in (
+                ("spec_version", "2.0"), ("version", "2.0"), ("baseScore", base_score_v2),
+                ("accessVector", v2_get('access_vector')), ("accessComplexity", v2_get('access_complexity')),
+                ("authentication", v2_get('authentication')), ("confidentialityImpact", v2_get('confidentiality_impact')),
+                ("integrityImpact", v2_get('integrity_impact')), ("availabilityImpact", v2_get('availability_impact')),
+            ) if v is not None}
+            extensions[CVSSV2_EXTENSION_ID] = cvss_v2_dict
 
     # --- Custom Properties ---
     custom_props = {}
-    cvss_v4_list = fp_vuln_data.get('cvss_v4s', [])
+    cvss_v4_list = vuln_get('cvss_v4s', [])
     if cvss_v4_list and isinstance(cvss_v4_list, list) and cvss_v4_list:
         cvss_v4_data = cvss_v4_list[0]
         if isinstance(cvss_v4_data, dict):
-            # --- CORRECTED Syntax for score parsing ---
-            base_score_v4, threat_score_v4 = None, None
-            try:
-                if cvss_v4_data.get('score') is not None: base_score_v4 = float(cvss_v4_data['score'])
-                if cvss_v4_data.get('threat_score') is not None: threat_score_v4 = float(cvss_v4_data['threat_score'])
-            except (ValueError, TypeError):
-                print(f"Warning: Could not parse CVSSv4 score for vuln {fp_id}")
-                base_score_v4, threat_score_v4 = None, None
-            # --- End Correction ---
+            base_score_v4 = _safe_float(cvss_v4_data.get('score'), "CVSSv4 score", fp_id)
+            threat_score_v4 = _safe_float(cvss_v4_data.get('threat_score'), "CVSSv4 threat score", fp_id)
             cvss_v4_prop_dict = {k: v for k, v in cvss_v4_data.items() if v is not None}
             if base_score_v4 is not None: cvss_v4_prop_dict['baseScore'] = base_score_v4
             elif 'score' in cvss_v4_prop_dict: del cvss_v4_prop_dict['score']
             if threat_score_v4 is not None: cvss_v4_prop_dict['threatScore'] = threat_score_v4
             elif 'threat_score' in cvss_v4_prop_dict: del cvss_v4_prop_dict['threat_score']
             if cvss_v4_prop_dict: custom_props['x_flashpoint_cvssv4'] = cvss_v4_prop_dict
-    epss_score = scores_dict.get('epss_score')
-    if epss_score is not None:
-        try: custom_props['x_flashpoint_epss_score'] = float(epss_score)
-        except (ValueError, TypeError): print(f"Warning: Could not parse EPSS score '{epss_score}' for vuln {fp_id}")
+    epss_score = _safe_float(score_get('epss_score'), "EPSS score", fp_id)
+    if epss_score is not None: custom_props['x_flashpoint_epss_score'] = epss_score
 
     # --- Create Vulnerability Object ---
+    now_ts = _fmt(datetime.now(timezone.utc))
     try:
-        vulnerability = Vulnerability(
-            name=fp_title or f"Flashpoint Vulnerability {fp_id}",
-            description=full_description,
-            created=created_at,
-            modified=modified_at,
-            external_references=external_references,
-            labels=sorted(list(set(labels))),
-            extensions=extensions if extensions else None,
-            object_marking_refs=[TLP_WHITE_DEFINITION.id], # Use ID
-            allow_custom=True,
-            **custom_props
-        )
+        if _FAST:
+            created_ts = _fmt(created_at) if created_at else now_ts
+            vulnerability = {
+                "type": "vulnerability", "spec_version": _STIX_SPEC_VERSION,
+                "id": f"vulnerability--{uuid.uuid5(_FP_ID_NAMESPACE, str(fp_id))}",
+                "created": created_ts,
+                "modified": _fmt(modified_at) if modified_at else created_ts,
+                "name": fp_title or f"Flashpoint Vulnerability {fp_id}",
+                "description": full_description,
+                "external_references": external_references,
+                "object_marking_refs": marking_refs,
+            }
+            if labels: vulnerability["labels"] = sorted(labels)
+            if extensions: vulnerability["extensions"] = extensions
+            vulnerability.update(custom_props)
+        else:
+            vulnerability = Vulnerability(
+                name=fp_title or f"Flashpoint Vulnerability {fp_id}",
+                description=full_description,
+                created=created_at,
+                modified=modified_at,
+                external_references=external_references,
+                labels=sorted(labels),
+                extensions=extensions if extensions else None,
+                object_marking_refs=marking_refs,
+                allow_custom=True,
+                **custom_props
+            )
         stix_objects.append(vulnerability)
     except Exception as e:
-        print(f"ERROR: Failed to create Vulnerability SDO for ID {fp_id}: {e}")
+        log.error("Failed to create Vulnerability SDO for ID %s: %s", fp_id, e)
         return [] # Skip this vulnerability if core object fails
 
     # --- Process Affected Products (Vendor/Product Only - Updated Logic) ---
-    products_list = fp_vuln_data.get('products', [])
-    vendors_list = fp_vuln_data.get('vendors', []) # Get top-level vendors list
+    products_list = vuln_get('products', [])
+    vendors_list = vuln_get('vendors', []) # Get top-level vendors list
 
-    # Create a lookup map for vendor IDs to names for efficiency
-    vendor_map = {}
-    if isinstance(vendors_list, list):
-        vendor_map = {v.get('id'): v.get('name') for v in vendors_list if isinstance(v, dict) and v.get('id') and v.get('name')}
+    # Normalize the sections once so one malformed section can't abandon the whole loop
+    if not isinstance(products_list, list):
+        if products_list: log.warning("Malformed 'products' section for vuln %s; skipping products.", fp_id)
+        products_list = []
+    if not isinstance(vendors_list, list):
+        if vendors_list: log.warning("Malformed 'vendors' section for vuln %s; ignoring it.", fp_id)
+        vendors_list = []
+
+    vendor_map = None # Local vendor ID -> name map, only built if global_vendor_map misses
 
-    if isinstance(products_list, list):
-        for i, product_info in enumerate(products_list):
-            if not isinstance(product_info, dict): continue
-            product_name = product_info.get('name')
-            if not product_name: continue # Skip if no product name
+    for i, product_info in enumerate(products_list):
+        try: product_name = product_info.get('name')
+        except AttributeError: continue # Not a dict
+        if not product_name: continue # Skip if no product name
 
-            vendor_name = None
+        try: # A bad product (e.g. unhashable vendor_id) only skips itself
             # Attempt 1: Get vendor name directly from product object
             vendor_name = product_info.get('vendor')
             # Attempt 2: If not found, try lookup using vendor_id from product object
             if not vendor_name:
                 vendor_id = product_info.get('vendor_id')
-                if vendor_id and vendor_id in vendor_map:
-                    vendor_name = vendor_map.get(vendor_id)
-            # Attempt 3: If still not found, assume positional correspondence if only 1 product/vendor
-            if not vendor_name and len(products_list) == 1 and len(vendors_list) == 1:
-                 if isinstance(vendors_list[0], dict):
-                      vendor_name = vendors_list[0].get('name')
-                      print(f"Info: Assuming single vendor '{vendor_name}' matches single product '{product_name}' for vuln {fp_id}")
-
-            # If we still couldn't determine a vendor name, skip
-            if not vendor_name:
-                 print(f"Warning: Could not determine vendor for product '{product_name}' (vuln {fp_id}). Skipping software/relationship creation.")
-                 continue
-
-            # Create Software object (NO VERSION)
-            cache_key = f"{vendor_name}::{product_name}" # Cache key
-
-            try: # Wrap software/relationship creation
-                if cache_key not in software_cache:
-                    software = Software( name=product_name, vendor=vendor_name,
-                        object_marking_refs=[TLP_WHITE_DEFINITION.id], allow_custom=True )
-                    stix_objects.append(software)
-                    software_cache[cache_key] = software
-                    print(f"Info: Created Software object for {product_name} by {vendor_name}")
-                else:
-                    software = software_cache[cache_key]
-                    print(f"Info: Reused cached Software object for {product_name} by {vendor_name}")
-
-                # Create Relationship: Vulnerability -> has -> Software
-                vuln_id_desc = next((ref.external_id for ref in external_references if ref.source_name == 'cve'), f"FP-{fp_id}")
-                rel_desc = f"Vulnerability {vuln_id_desc} affects {product_name} (by {vendor_name})"
+                if vendor_id:
+                    if global_vendor_map: vendor_name = global_vendor_map.get(vendor_id)
+                    if not vendor_name:
+                        if vendor_map is None: vendor_map = build_vendor_map(vendors_list)
+                        vendor_name = vendor_map.get(vendor_id)
+        except TypeError as e_vendor:
+            log.warning("Malformed product %r (vuln %s): %s", product_name, fp_id, e_vendor)
+            continue
+        # Attempt 3: If still not found, assume positional correspondence if only 1 product/vendor
+        if not vendor_name and len(products_list) == 1 and len(vendors_list) == 1:
+             try: vendor_name = vendors_list[0].get('name')
+             except AttributeError: pass # Not a list of dicts
+             else:
+                  log.info("Assuming single vendor %r matches single product %r for vuln %s", vendor_name, product_name, fp_id)
+
+        # If we still couldn't determine a vendor name, skip
+        if not vendor_name:
+             log.warning("Could not determine vendor for product %r (vuln %s). Skipping software/relationship creation.", product_name, fp_id)
+             continue
+
+        # Create Software object (NO VERSION)
+        try: # Wrap software/relationship creation
+            software = _get_software(vendor_name, product_name)
+            if software['id'] not in emitted_software_ids:
+                stix_objects.append(software)
+                emitted_software_ids.add(software['id'])
+                log.debug("Added Software object for %s by %s", product_name, vendor_name)
+            else:
+                log.debug("Reused cached Software object for %s by %s", product_name, vendor_name)
+
+            # Create Relationship: Vulnerability -> has -> Software
+            vuln_id_desc = next((ref['external_id'] for ref in external_references if ref['source_name'] == 'cve'), f"FP-{fp_id}")
+            rel_desc = f"Vulnerability {vuln_id_desc} affects {product_name} (by {vendor_name})"
+            if _FAST:
+                rel = { "type": "relationship", "spec_version": _STIX_SPEC_VERSION, "id": f"relationship--{uuid.uuid4()}",
+                        "created": now_ts, "modified": now_ts, "relationship_type": "has",
+                        "source_ref": vulnerability["id"], "target_ref": software["id"],
+                        "description": rel_desc, "object_marking_refs": marking_refs }
+            else:
                 rel = Relationship( vulnerability, 'has', software, description=rel_desc,
-                                    object_marking_refs=[TLP_WHITE_DEFINITION.id] )
-                stix_objects.append(rel)
-            except Exception as e_sw_rel:
-                print(f"ERROR: Failed creating base Software/Relationship for product '{product_name}' (vuln {fp_id}): {e_sw_rel}")
+                                    object_marking_refs=marking_refs )
+            stix_objects.append(rel)
+        except Exception as e_sw_rel:
+            log.error("Failed creating base Software/Relationship for product %r (vuln %s): %s", product_name, fp_id, e_sw_rel)
+
+    return stix_objects
 
-    return stix_objects
\ No newline at end of file
+
+# --- Batch Mapping ---
+
+def validate_stix_objects(stix_objects):
+    """Development check for the plain-dict output: parses each distinct object with stix2 (raises on the first invalid one)."""
+    validated_count = 0
+    for o in unique_stix_objects(stix_objects):
+        if not isinstance(o, dict): continue # stix2 objects were validated when built
+        stix2_parse(o, allow_custom=True); validated_count += 1
+    return validated_count
+
+def map_batch(fp_vulns, workers=None, chunksize=32, global_vendor_map=None):
+    """
+    Maps many Flashpoint vulnerabilities across worker processes and returns one flat list of STIX objects.
+    Each vulnerability is mapped independently; TLP_WHITE_DEFINITION is built at import time in every worker.
+    """
+    mapper = functools.partial(map_flashpoint_vuln_to_stix, global_vendor_map=global_vendor_map) if global_vendor_map else map_flashpoint_vuln_to_stix
+    stix_objects = []
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for objs in executor.map(mapper, fp_vulns, chunksize=chunksize):
+            stix_objects.extend(objs)
+    return stix_objects
+
+def map_flashpoint_stream(fp, prefix='results.item', workers=None, batch_size=1000):
+    """
+    Incrementally maps a Flashpoint JSON export (binary file object) to STIX, yielding objects one vulnerability at a time.
+    `prefix` is the ijson path of the vulnerability array ('results.item' for API pages, 'data.item' or 'item' for other dumps).
+    With `workers`, vulnerabilities are read in batches of `batch_size` and mapped in parallel, keeping memory bounded.
+    """
+    fp_vulns = ijson.items(fp, prefix, use_float=True)
+    if not workers:
+        for fp_vuln_data in fp_vulns:
+            yield from map_flashpoint_vuln_to_stix(fp_vuln_data)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while batch := list(islice(fp_vulns, batch_size)):
+            for objs in executor.map(map_flashpoint_vuln_to_stix, batch, chunksize=32):
+                yield from objs